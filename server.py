@@ -1,75 +1,314 @@
 # server.py
-import os, uuid, json, asyncio
+import os, sys, uuid, heapq, asyncio
+from contextlib import asynccontextmanager
+import orjson
+from anyio import to_thread
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
 import uvicorn
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # index.html は起動時に一度だけ読み込んでメモリに保持する（読み込みはスレッドで行う）
+    app.state.index_html = await to_thread.run_sync(read_index_html)
+    yield
 
-# players: uid -> {
-#   "ws": WebSocket | None,
-#   "connected": bool,
-#   "in_game_area": bool,
-#   "slot_idx": int | None   # None = no slot (観戦/ロビー)
-# }
-app.state.players = {}
-# ordered list of uids that currently occupy game slots (before/after start)
-app.state.slots = []  # [uid1, uid2, ...]
+
+app = FastAPI(lifespan=lifespan)
+
+# プレイヤー情報は uid をキーにした属性ごとの dict で持つ
+# connected_ws: uid -> WebSocket（接続中のプレイヤーのみ）
+app.state.connected_ws = {}
+# send_queue / writer_task: uid -> 接続ごとの送信キューとそれを捌く writer タスク（接続中のみ）
+app.state.send_queue = {}
+app.state.writer_task = {}
+# slot_idx: uid -> int | None   # None = no slot (観戦/ロビー)。登録済み uid の一覧も兼ねる
+app.state.slot_idx = {}
+# in_game_area / in_watch_area: uid -> bool
+app.state.in_game_area = {}
+app.state.in_watch_area = {}
+# game slots: slot_idx -> uid（退出しても他の slot_idx は変わらない）
+app.state.slots = {}  # {0: uid1, 1: uid2, ...}
+# 空いた slot_idx の min-heap（小さい番号から再利用する）
+app.state.free_slots = []
+# ゲームに参加できる最大人数（スロット数）
+MAX_SLOTS = 16
+# slot_idx -> 表示ラベル（"1P", "2P", ...）を起動時に作っておく
+SLOT_LABELS = tuple(f"{i+1}P" for i in range(MAX_SLOTS))
 app.state.game_started = False
-app.state.lock = asyncio.Lock()  # 保護用（軽い排他）
+# 共有状態はイベントループ（単一スレッド）の中だけで触り、更新の途中に await を挟まないので lock は不要
 # このスクリプト自身のディレクトリを取得
 app.state.base_dir = os.path.dirname(os.path.abspath(__file__))
+# 開発用: GET / のたびに index.html を読み直す（編集をリロードで反映したいとき）
+RELOAD_INDEX_HTML = os.environ.get("RELOAD_INDEX_HTML", "0") == "1"
+# 接続ごとの送信キューの上限（溢れたら遅いクライアントとして切断する）
+SEND_QUEUE_SIZE = 256
+# テキストフレームの JSON コマンド（{"type": "PING"} など）を受け付けるか（旧クライアント互換）
+ACCEPT_JSON_COMMANDS = os.environ.get("ACCEPT_JSON_COMMANDS", "1") != "0"
+# 切断処理中のタスク（GC で消えないよう参照を持っておく）
+app.state.closing_tasks = set()
+
+def read_index_html() -> str:
+    with open(os.path.join(app.state.base_dir, "index.html"), "r", encoding="utf-8") as f:
+        return f.read()
+
 
 @app.get("/")
 async def get():
-    with open(os.path.join(app.state.base_dir, "index.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(f.read())
+    if RELOAD_INDEX_HTML:
+        # ファイル読み込みでイベントループを止めないようスレッドで読む
+        app.state.index_html = await to_thread.run_sync(read_index_html)
+    return HTMLResponse(app.state.index_html)
 
 
-async def send_safe(ws: WebSocket, message: dict):
+async def send_safe_raw(ws: WebSocket, payload: str):
+    # シリアライズ済みの payload をそのまま送る
     try:
-        await ws.send_text(json.dumps(message))
+        await ws.send_text(payload)
     except Exception:
         # 送信失敗しても落とさない
         pass
 
 
-async def send_safe_key(ws: WebSocket, type: str, key: str=None, value=None):
+async def send_safe(ws: WebSocket, message: dict):
+    await send_safe_raw(ws, orjson.dumps(message).decode())
+
+
+async def send_safe_key(ws: WebSocket, type: str, key: str = None, value=None):
     if key is None:
         await send_safe(ws, {"type": type})
     else:
         await send_safe(ws, {"type": type, key: value})
 
 
-async def broadcast(type: str, key: str, msg: str):
-    # 全接続中の client に送る
-    for p in list(app.state.players.values()):
-        ws = p.get("ws")
-        if ws is not None and p.get("connected"):
-            await send_safe(ws, {"type": type, key: msg})
+async def writer(ws: WebSocket, queue: asyncio.Queue):
+    # queue に積まれた payload を順に送る（接続ごとに 1 タスク）
+    try:
+        while True:
+            payload = await queue.get()
+            await ws.send_text(payload)
+    except Exception:
+        # 送信失敗しても落とさない（切断は受信側で処理される）
+        pass
+
+
+async def close_safe(ws: WebSocket):
+    try:
+        await ws.close()
+    except Exception:
+        pass
+
+
+def attach_ws(uid, ws: WebSocket):
+    # 接続中として登録し、送信キューと writer タスクを用意する
+    detach_ws(uid)
+    queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    app.state.connected_ws[uid] = ws
+    app.state.send_queue[uid] = queue
+    app.state.writer_task[uid] = asyncio.create_task(writer(ws, queue))
+
+
+def detach_ws(uid):
+    # 接続中から外し、writer タスクを止める（未送信分は捨てる）
+    app.state.connected_ws.pop(uid, None)
+    app.state.send_queue.pop(uid, None)
+    task = app.state.writer_task.pop(uid, None)
+    if task is not None:
+        task.cancel()
+
+
+def enqueue_all(payload: str):
+    # 各接続の queue に積むだけ（送信は writer タスクが行うので待たない）
+    # 途中に await が無いので send_queue をコピーせず直接回してよい
+    slow = []
+    for uid, queue in app.state.send_queue.items():
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            slow.append(uid)
+    for uid in slow:
+        # 捌ききれない遅いクライアントは切断する（後始末は WebSocketDisconnect 側）
+        ws = app.state.connected_ws.get(uid)
+        detach_ws(uid)
+        if ws is not None:
+            task = asyncio.create_task(close_safe(ws))
+            app.state.closing_tasks.add(task)
+            task.add_done_callback(app.state.closing_tasks.discard)
+
+
+def broadcast(type: str, key: str, value):
+    # 送信者本人も含めて全員に送る（本人も SLOT_ADD / GAME_START で画面を更新するので除外しない）
+    # 省略するのは接続が 1 つも無いとき（最後の 1 人の切断など）の JSON 化だけ
+    if app.state.send_queue:
+        # JSON 化は受信者ごとではなく 1 回だけ
+        enqueue_all(orjson.dumps({"type": type, key: value}).decode())
 
 
 def slot_label(idx: int) -> str:
-    return f"{idx+1}P"
+    return SLOT_LABELS[idx]
 
 
-async def notify_slots_update():
-    # slot 情報を全員に送る（JSON）
+def slots_snapshot():
+    # slot 情報の全体（接続直後の HELLO 用。以降の変更は SLOT_ADD / SLOT_REMOVE）
     slots_info = []
-    for idx, uid in enumerate(app.state.slots):
+    for idx, uid in sorted(app.state.slots.items()):
         slots_info.append({"slot": slot_label(idx), "uid": uid})
-    await broadcast("SLOTS", "slots_info", slots_info)
+    return slots_info
+
+
+def assign_slot(uid):
+    # 空き slot があれば最小番号を、なければ末尾を割り当てる（満員なら None）
+    owned = app.state.slot_idx.get(uid)
+    if owned is not None and app.state.slots.get(owned) == uid:
+        # 既に slot を持っているなら 2 つ目は渡さない
+        return owned
+    free = app.state.free_slots
+    if free:
+        idx = heapq.heappop(free)
+    elif len(app.state.slots) < MAX_SLOTS:
+        idx = len(app.state.slots)
+    else:
+        return None
+    app.state.slots[idx] = uid
+    return idx
+
+
+def release_slot(idx: int):
+    del app.state.slots[idx]
+    heapq.heappush(app.state.free_slots, idx)
 
 
-def register_player(uid, ws: WebSocket, connect: bool, game_area: bool, watch_area: bool, slot):
-    app.state.players[uid] = {
-        "ws": ws,
-        "connected": connect,
-        "in_game_area": game_area,
-        "in_watch_area": watch_area,
-        "slot_idx": slot,
-    }
+def register_player(uid, ws: WebSocket, game_area: bool, watch_area: bool, slot):
+    attach_ws(uid, ws)
+    app.state.slot_idx[uid] = slot
+    app.state.in_game_area[uid] = game_area
+    app.state.in_watch_area[uid] = watch_area
+
+
+# --- コマンドごとのハンドラ（websocket, uid） ---
+# 状態の更新は await を挟まずに済ませる（broadcast は queue に積むだけで await しない）
+
+async def handle_ping(websocket: WebSocket, uid: str):
+    await send_safe_key(websocket, "PONG")
+
+
+async def handle_enter_spectate(websocket: WebSocket, uid: str):
+    # ENTER_SPECTATE: 観戦エリアへ（ゲーム開始前なら持っている slot を空ける）
+    state = app.state
+    slot = state.slot_idx[uid]
+    state.in_game_area[uid] = False
+    state.in_watch_area[uid] = True
+    state.slot_idx[uid] = None
+    if slot is not None and not state.game_started:
+        release_slot(slot)
+        broadcast("SLOT_REMOVE", "slot", slot_label(slot))
+    await send_safe_key(websocket, "ENTERED_SPECTATE")
+
+
+async def handle_enter_game(websocket: WebSocket, uid: str):
+    # ENTER_GAME: ゲームエリアに入るリクエスト
+    state = app.state
+    slot = state.slot_idx[uid]
+    # ゲーム開始後は、既存参加者のみ復帰可能（それ以外は観戦に誘導）
+    if state.game_started:
+        # 既に slot を持っている参加者なら復帰を許可
+        if slot is not None:
+            state.in_game_area[uid] = True
+            state.in_watch_area[uid] = False
+            reply = ("JOINED", "slot", slot_label(slot))
+        else:
+            # 新規参加不可（観戦へ）
+            state.in_game_area[uid] = False
+            state.in_watch_area[uid] = True
+            reply = ("ONLY_SPECTATOR",)
+            # ここでは接続を切らずクライアント側でリダイレクトさせる想定
+    # ゲーム未開始の通常入室処理：
+    # もし既に slots に入っている（＝先に入っていて再接続したケース）は復帰
+    elif slot is not None:
+        # すでにどこかのスロットに入っている（通常はないが安全のため）
+        state.in_game_area[uid] = True
+        state.in_watch_area[uid] = False
+        reply = ("JOINED", "slot", slot_label(slot))
+    else:
+        # 新規にスロット割当て（空きの最小番号 or 末尾）
+        new_idx = assign_slot(uid)
+        if new_idx is None:
+            # 空きスロットなし
+            reply = ("FULL",)
+        else:
+            state.slot_idx[uid] = new_idx
+            state.in_game_area[uid] = True
+            state.in_watch_area[uid] = False
+            reply = ("JOINED", "slot", slot_label(new_idx))
+            # 全員にスロット追加を通知（差分のみ）
+            broadcast("SLOT_ADD", "slot_info", {"slot": slot_label(new_idx), "uid": uid})
+    await send_safe_key(websocket, *reply)
+
+
+async def handle_leave_game(websocket: WebSocket, uid: str):
+    # LEAVE_GAME: ゲームエリアから抜ける（ゲーム開始前なら slot を空ける）
+    state = app.state
+    slot = state.slot_idx[uid]
+    if state.in_game_area[uid] and slot is not None:
+        # ゲーム未開始なら slot を空ける（他の slot_idx はそのまま）
+        if not state.game_started:
+            release_slot(slot)
+            # clear this player's slot
+            state.slot_idx[uid] = None
+            state.in_game_area[uid] = False
+            broadcast("SLOT_REMOVE", "slot", slot_label(slot))
+        else:
+            # ゲーム開始後に抜ける（切断扱いと同じ：in_game_area False だが slot は保持）
+            state.in_game_area[uid] = False
+            detach_ws(uid)
+            # 他の参加者に通知
+            broadcast("PLAYER_LEFT", "user_id", uid)
+    else:
+        # そもそもゲームエリアにいない
+        state.in_game_area[uid] = False
+
+
+async def handle_start(websocket: WebSocket, uid: str):
+    # START: 先頭スロット（通常は 1P）が開始ボタンを押す
+    state = app.state
+    slot = state.slot_idx[uid]
+    # only the lowest occupied slot can start, and must be in game area and connected
+    started = (slot is not None and slot == min(state.slots)
+               and state.in_game_area[uid] and not state.game_started)
+    if started:
+        state.game_started = True
+        # notify all connected clients
+        broadcast("GAME_START", "player_count", len(state.slots))
+        # after game start, people in lobby (without slot) cannot enter game area;
+        # spectators remain allowed.
+    else:
+        await send_safe_key(websocket, "START_DENIED")
+
+
+# バイナリフレームの先頭 1 バイトがコマンドの opcode（index.html の OP と揃える）
+OP_PING = 1
+OP_ENTER_GAME = 2
+OP_ENTER_SPECTATE = 3
+OP_LEAVE_GAME = 4
+OP_START = 5
+
+# opcode -> handler（index で引く）
+OP_HANDLERS = [None] * (OP_START + 1)
+OP_HANDLERS[OP_PING] = handle_ping
+OP_HANDLERS[OP_ENTER_GAME] = handle_enter_game
+OP_HANDLERS[OP_ENTER_SPECTATE] = handle_enter_spectate
+OP_HANDLERS[OP_LEAVE_GAME] = handle_leave_game
+OP_HANDLERS[OP_START] = handle_start
+
+# JSON コマンドの type -> handler
+HANDLERS = {
+    "PING": handle_ping,
+    "ENTER_SPECTATE": handle_enter_spectate,
+    "ENTER_GAME": handle_enter_game,
+    "LEAVE_GAME": handle_leave_game,
+    "START": handle_start,
+}
 
 
 @app.websocket("/ws")
@@ -78,184 +317,117 @@ async def websocket_endpoint(websocket: WebSocket):
 
     # query から uid を取得。なければ新規発行
     query_uid = websocket.query_params.get("uid")
-    async with app.state.lock:
-        if not query_uid:
-            uid = str(uuid.uuid4())
-            # 新規プレイヤー登録（仮状態: ロビー・未接続スロット）
-            register_player(uid=uid, ws=websocket, connect=True, game_area=False, watch_area=False, slot=None)
-            # 送信順：ASSIGN_ID を先に送る
-            await send_safe_key(websocket, type="ASSIGN_ID", key="user_id", value=uid)
+    if not query_uid:
+        uid = str(uuid.uuid4())
+        # 新規プレイヤー登録（仮状態: ロビー・未接続スロット）
+        register_player(uid=uid, ws=websocket, game_area=False, watch_area=False, slot=None)
+    else:
+        uid = query_uid
+        # 既存 UID の扱い
+        if uid not in app.state.slot_idx:
+            # 未登録ユーザー（初めて来たがuidを指定しているケース）
+            register_player(uid=uid, ws=websocket, game_area=False, watch_area=False, slot=None)
         else:
-            uid = query_uid
-            # 既存 UID の扱い
-            p = app.state.players.get(uid)
-            if p is None:
-                # 未登録ユーザー（初めて来たがuidを指定しているケース）
-                register_player(uid=uid, ws=websocket, connect=True, game_area=False, watch_area=False, slot=None)
-                await send_safe_key(websocket, type="ASSIGN_ID", key="user_id", value=uid)
-            else:
-                # 再接続：ws を差し替え、connected True にする
-                p["ws"] = websocket
-                p["connected"] = True
-                # ASSIGN_ID は重複送信不要だがあってもOK
-                await send_safe_key(websocket, type="ASSIGN_ID", key="user_id", value=uid)
+            # 再接続：ws を差し替えて接続中にする
+            attach_ws(uid, websocket)
+    # uid の通知・接続完了・初期スロット情報をまとめて 1 フレームで送る
+    # （登録と同時に自分の queue に積むので、後続の broadcast より必ず先に届く。
+    #   PONG / JOINED などの直接の返信は queue を通らないので、broadcast との順序は保証しない）
+    hello = {"type": "HELLO", "user_id": uid, "connected": True, "slots_info": slots_snapshot()}
+    app.state.send_queue[uid].put_nowait(orjson.dumps(hello).decode())
 
     # 当接続のループ
     try:
-        # inform client it's connected
-        await send_safe_key(websocket, type="CONNECTED")
-        # 初期スロット情報を送る
-        await notify_slots_update()
-
         while True:
-            data = await websocket.receive_text()
-            # simple text protocol:
-            # ENTER_GAME / ENTER_SPECTATE / LEAVE_GAME / START / PING
-            msg = json.loads(data)
-
-            async with app.state.lock:
-                p = app.state.players.get(uid)
-                if p is None:
-                    # ちょっと安全側: 登録されてないなら作る
-                    register_player(uid=uid, ws=websocket, connect=True, game_area=False, watch_area=False, slot=None)
-                    p = app.state.players[uid]
-
-                # PING 用
-                if msg["type"] == "PING":
-                    await send_safe_key(websocket, type="PONG")
-                    continue
-
-                # ENTER_SPECTATE: 観戦エリアへ（slot には触らない）
-                if msg["type"] == "ENTER_SPECTATE":
-                    p["in_game_area"] = False
-                    p["in_watch_area"] = True
-                    p["slot_idx"] = None
-                    await send_safe_key(websocket, type="ENTERED_SPECTATE")
-                    continue
-
-                # ENTER_GAME: ゲームエリアに入るリクエスト
-                if msg["type"] == "ENTER_GAME":
-                    # ゲーム開始後は、既存参加者のみ復帰可能（それ以外は観戦に誘導）
-                    if app.state.game_started:
-                        # 既に slot を持っている参加者なら復帰を許可
-                        if p["slot_idx"] is not None:
-                            p["in_game_area"] = True
-                            p["in_watch_area"] = False
-                            await send_safe_key(websocket, "JOINED", "slot", slot_label(p['slot_idx']))
-                        else:
-                            # 新規参加不可（観戦へ）
-                            p["in_game_area"] = False
-                            p["in_watch_area"] = True
-                            p["slot_idx"] = None
-                            await send_safe_key(websocket, type="ONLY_SPECTATOR")
-                            # ここでは接続を切らずクライアント側でリダイレクトさせる想定
-                        continue
-                    # ゲーム未開始の通常入室処理：
-                    # もし既に slots に入っている（＝先に入っていて再接続したケース）は復帰
-                    if p["slot_idx"] is not None:
-                        # すでにどこかのスロットに入っている（通常はないが安全のため）
-                        p["in_game_area"] = True
-                        p["in_watch_area"] = False
-                        await send_safe_key(websocket, "JOINED", "slot", slot_label(p['slot_idx']))
-                    else:
-                        # 新規にスロット割当て（末尾に追加）
-                        app.state.slots.append(uid)
-                        new_idx = len(app.state.slots) - 1
-                        p["slot_idx"] = new_idx
-                        p["in_game_area"] = True
-                        p["in_watch_area"] = False
-                        await send_safe_key(websocket, "JOINED", "slot", slot_label(new_idx))
-                        # 全員にスロット更新通知
-                        await notify_slots_update()
-                    continue
-
-                # LEAVE_GAME: ゲームエリアから抜ける（ゲーム開始前なら slot を削除して繰り上げ）
-                if msg["type"] == "LEAVE_GAME":
-                    if p["in_game_area"] and p["slot_idx"] is not None:
-                        # ゲーム未開始なら slot を削除して繰り上げ
-                        if not app.state.game_started:
-                            # remove from slots list
-                            idx = p["slot_idx"]
-                            try:
-                                app.state.slots.pop(idx)
-                            except Exception:
-                                pass
-                            # clear this player's slot
-                            p["slot_idx"] = None
-                            p["in_game_area"] = False
-                            # 更新: 他の slot_idx を再計算
-                            for new_idx, uid in enumerate(app.state.slots):
-                                player_obj = app.state.players.get(uid)
-                                if player_obj is not None:
-                                    player_obj["slot_idx"] = new_idx
-                            await notify_slots_update()
-                        else:
-                            # ゲーム開始後に抜ける（切断扱いと同じ：in_game_area False だが slot は保持）
-                            p["in_game_area"] = False
-                            p["connected"] = False
-                            p["ws"] = None
-                            # 他の参加者に通知
-                            await broadcast("PLAYER_LEFT", "user_id", uid)
-                    else:
-                        # そもそもゲームエリアにいない
-                        p["in_game_area"] = False
-                    continue
-
-                # START: 1P が開始ボタンを押す
-                if msg["type"] == "START":
-                    # only 1P can start, and must be in game area and connected
-                    if p["slot_idx"] == 0 and p["in_game_area"] and not app.state.game_started:
-                        app.state.game_started = True
-                        # notify all connected clients
-                        await broadcast(f"GAME_START {len(app.state.slots)}")
-                        # after game start, people in lobby (without slot) cannot enter game area;
-                        # spectators remain allowed.
-                        continue
-                    else:
-                        await send_safe_key(websocket, "START_DENIED")
-                        continue
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # binary protocol: 1 バイトの opcode
+            # OP_PING / OP_ENTER_GAME / OP_ENTER_SPECTATE / OP_LEAVE_GAME / OP_START
+            data = message.get("bytes")
+            if data is not None:
+                op = data[0] if data else 0
+                handler = OP_HANDLERS[op] if op < len(OP_HANDLERS) else None
+                echo = data.hex()
+            else:
+                # 旧 JSON テキストプロトコル: {"type": "ENTER_GAME"} など
+                data = message.get("text")
+                handler = None
+                if ACCEPT_JSON_COMMANDS:
+                    try:
+                        msg = orjson.loads(data)
+                    except orjson.JSONDecodeError:
+                        # 壊れた JSON は未知のコマンドとして ECHO を返す
+                        msg = None
+                    if isinstance(msg, dict):
+                        handler = HANDLERS.get(msg.get("type"))
+                echo = data
 
+            if uid not in app.state.slot_idx:
+                # ちょっと安全側: 登録されてないなら作る
+                register_player(uid=uid, ws=websocket, game_area=False, watch_area=False, slot=None)
+
+            if handler is None:
                 # Unknown command -> echo
-                await send_safe_key(websocket, "ECHO", "data", data)
+                await send_safe_key(websocket, "ECHO", "data", echo)
+            else:
+                await handler(websocket, uid)
 
     except WebSocketDisconnect:
         # 切断時の処理
-        async with app.state.lock:
-            p = app.state.players.get(uid)
-            if p is None:
-                return
-            # 切断の種類で処理を分ける
-            p["connected"] = False
-            p["ws"] = None
-            # ゲーム開始前かどうか
-            if not app.state.game_started:
-                # 切断したプレイヤーがスロットを占有していたら削除して繰り上げ
-                if p.get("slot_idx") is not None:
-                    idx = p["slot_idx"]
-                    try:
-                        app.state.slots.pop(idx)
-                    except Exception:
-                        pass
-                    # プレイヤーの slot_idx を None にする（IDは消す）
-                    p["slot_idx"] = None
-                    p["in_game_area"] = False
-                    p["in_watch_area"] = False
-                    # 再割り当て（slot_idx を更新）
-                    for new_idx, uid in enumerate(app.state.slots):
-                        player_obj = app.state.players.get(uid)
-                        if player_obj is not None:
-                            player_obj["slot_idx"] = new_idx
-                    # 通知
-                    await notify_slots_update()
-                else:
-                    # そもそもスロット無し（観戦orロビー）なら何もしない
-                    pass
+        state = app.state
+        if uid not in state.slot_idx:
+            return
+        current = state.connected_ws.get(uid)
+        if current is not None and current is not websocket:
+            # 同じ uid で再接続済み（古い接続の切断）なら新しい接続の状態には触らない
+            return
+        # 切断の種類で処理を分ける
+        if current is websocket:
+            detach_ws(uid)
+        slot = state.slot_idx[uid]
+        # ゲーム開始前かどうか
+        if not state.game_started:
+            # 切断したプレイヤーがスロットを占有していたら空ける
+            if slot is not None:
+                release_slot(slot)
+                # プレイヤーの slot_idx を None にする（IDは消す）
+                state.slot_idx[uid] = None
+                state.in_game_area[uid] = False
+                state.in_watch_area[uid] = False
+                # 通知（状態の更新後）
+                broadcast("SLOT_REMOVE", "slot", slot_label(slot))
             else:
-                # ゲーム開始後の切断は slot を保持（復帰可能）
-                # なのでここでは connected=False にしておくだけでOK
-                await broadcast("PLAYER_DISCONNECTED", "user_id", uid)
+                # そもそもスロット無し（観戦orロビー）なら何もしない
+                pass
+        else:
+            # ゲーム開始後の切断は slot を保持（復帰可能）
+            # なのでここでは connected_ws から外しておくだけでOK
+            broadcast("PLAYER_DISCONNECTED", "user_id", uid)
         return
+    finally:
+        # WebSocketDisconnect 以外で抜けた場合も writer タスクと queue を残さない
+        # （再接続で差し替わっていたら新しい接続のものなので触らない）
+        if app.state.connected_ws.get(uid) is websocket:
+            detach_ws(uid)
 
 
 if __name__ == "__main__":
-    uvicorn.run("server:app", host="0.0.0.0", port=10000)
+    # 通常は uvicorn に任せる（"auto": uvloop が入っていれば uvloop、なければ asyncio。Windows には uvloop は無い）
+    loop = "auto"
+    # Linux で uringcore（任意依存）が入っていれば io_uring ベースのループを使う
+    if sys.platform.startswith("linux"):
+        try:
+            import uringcore
+        except ImportError:
+            pass
+        else:
+            asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+            # uvicorn 側でループを差し替えないよう asyncio を指定（ポリシーが使われる）
+            loop = "asyncio"
+    # UVICORN_UDS が指定されていれば TCP ではなく Unix Domain Socket で待ち受ける
+    # （nginx の背後に置く構成。deploy/nginx.conf を参照）
+    uds = os.environ.get("UVICORN_UDS")
+    bind = {"uds": uds} if uds else {"host": "0.0.0.0", "port": 10000}
+    # WebSocket / HTTP パーサも uvicorn[standard] に含まれる高速実装を明示的に使う
+    uvicorn.run("server:app", **bind, loop=loop, ws="websockets", http="httptools")
@@ -0,0 +1,145 @@
+# test_server.py
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from server import app, MAX_SLOTS, OP_PING, OP_ENTER_GAME, OP_ENTER_SPECTATE, OP_START, assign_slot
+
+
+@pytest.fixture
+def client():
+    # app.state はモジュール単位で共有されるのでテストごとに初期化する
+    app.state.connected_ws.clear()
+    app.state.send_queue.clear()
+    app.state.writer_task.clear()
+    app.state.slot_idx.clear()
+    app.state.in_game_area.clear()
+    app.state.in_watch_area.clear()
+    app.state.slots.clear()
+    app.state.free_slots.clear()
+    app.state.game_started = False
+    with TestClient(app) as c:
+        yield c
+
+
+def receive(ws, count):
+    # 直接の返信と broadcast は経路が違うので type -> message の dict で受け取る
+    messages = {}
+    for _ in range(count):
+        msg = ws.receive_json()
+        messages[msg["type"]] = msg
+    return messages
+
+
+def test_index_html_is_served(client):
+    response = client.get("/")
+    assert response.status_code == 200
+    assert "<title>Lobby / Game / Watch Demo</title>" in response.text
+
+
+def test_enter_spectate_releases_slot(client):
+    with client.websocket_connect("/ws?uid=a") as a:
+        receive(a, 1)  # HELLO
+        for _ in range(MAX_SLOTS + 1):
+            a.send_bytes(bytes([OP_ENTER_GAME]))
+            assert receive(a, 2)["JOINED"]["slot"] == "1P"
+            a.send_bytes(bytes([OP_ENTER_SPECTATE]))
+            first = a.receive_json()
+            # 何か届いた時点で状態の更新は済んでいる（slot が残っていれば 2 通目を待たずに失敗させる）
+            assert app.state.slots == {}
+            messages = {first["type"]: first, **receive(a, 1)}
+            assert messages["SLOT_REMOVE"] == {"type": "SLOT_REMOVE", "slot": "1P"}
+            assert "ENTERED_SPECTATE" in messages
+
+        with client.websocket_connect("/ws?uid=b") as b:
+            receive(b, 1)  # HELLO
+            b.send_bytes(bytes([OP_ENTER_GAME]))
+            assert receive(b, 2)["JOINED"]["slot"] == "1P"
+
+
+def test_rejoined_host_can_start(client):
+    with client.websocket_connect("/ws?uid=a") as a, client.websocket_connect("/ws?uid=b") as b:
+        receive(a, 1)
+        receive(b, 1)
+        a.send_bytes(bytes([OP_ENTER_GAME]))
+        receive(a, 2)
+        receive(b, 1)
+        b.send_bytes(bytes([OP_ENTER_GAME]))
+        assert receive(b, 2)["JOINED"]["slot"] == "2P"
+        receive(a, 1)
+        # 1P が観戦に移って戻ると、空いた 1P に戻る（slot は 1 人 1 つ）
+        a.send_bytes(bytes([OP_ENTER_SPECTATE]))
+        receive(a, 2)
+        receive(b, 1)
+        a.send_bytes(bytes([OP_ENTER_GAME]))
+        assert receive(a, 2)["JOINED"]["slot"] == "1P"
+        receive(b, 1)
+        assert app.state.slots == {0: "a", 1: "b"}
+
+        a.send_bytes(bytes([OP_START]))
+        assert receive(a, 1)["GAME_START"]["player_count"] == 2
+        assert receive(b, 1)["GAME_START"]["player_count"] == 2
+
+
+def test_stale_disconnect_keeps_reconnected_socket(client):
+    with client.websocket_connect("/ws?uid=a") as old:
+        receive(old, 1)
+        old.send_bytes(bytes([OP_ENTER_GAME]))
+        receive(old, 2)
+        with client.websocket_connect("/ws?uid=a") as new:
+            receive(new, 1)
+            old.close()
+            # 古い接続が切れても新しい接続と slot はそのまま
+            new.send_bytes(bytes([OP_PING]))
+            assert receive(new, 1)["PONG"]
+            assert app.state.slots == {0: "a"}
+            assert "a" in app.state.send_queue
+            with client.websocket_connect("/ws?uid=b") as b:
+                receive(b, 1)
+                b.send_bytes(bytes([OP_ENTER_GAME]))
+                receive(b, 2)
+                assert receive(new, 1)["SLOT_ADD"]["slot_info"] == {"slot": "2P", "uid": "b"}
+
+
+def test_handler_error_detaches_connection(client, monkeypatch):
+    async def broken(websocket, uid):
+        raise RuntimeError("boom")
+
+    handlers = list(server.OP_HANDLERS)
+    handlers[OP_PING] = broken
+    monkeypatch.setattr(server, "OP_HANDLERS", handlers)
+    with pytest.raises(RuntimeError):
+        with client.websocket_connect("/ws?uid=a") as a:
+            receive(a, 1)
+            a.send_bytes(bytes([OP_PING]))
+            a.receive_json()
+    assert "a" not in app.state.send_queue
+    assert "a" not in app.state.writer_task
+    assert "a" not in app.state.connected_ws
+
+
+@pytest.mark.parametrize("text", ["not json", "[1, 2]", '"PING"', '{"type": "NOPE"}'])
+def test_invalid_json_command_is_echoed(client, text):
+    with client.websocket_connect("/ws?uid=a") as a:
+        receive(a, 1)
+        a.send_text(text)
+        assert a.receive_json() == {"type": "ECHO", "data": text}
+        # 接続はそのまま使える
+        a.send_text('{"type": "PING"}')
+        assert a.receive_json() == {"type": "PONG"}
+
+
+def test_lone_player_receives_own_broadcasts(client):
+    # 1 人だけのロビーでも broadcast を省略しない（index.html は自分の SLOT_ADD / GAME_START で画面を更新する）
+    with client.websocket_connect("/ws?uid=a") as a:
+        receive(a, 1)
+        a.send_bytes(bytes([OP_ENTER_GAME]))
+        assert receive(a, 2)["SLOT_ADD"]["slot_info"] == {"slot": "1P", "uid": "a"}
+        a.send_bytes(bytes([OP_START]))
+        assert receive(a, 1)["GAME_START"]["player_count"] == 1
+
+
+def test_assign_slot_does_not_give_second_slot(client):
+    app.state.slot_idx["a"] = assign_slot("a")
+    assert assign_slot("a") == 0
+    assert app.state.slots == {0: "a"}